@@ -1,153 +1,471 @@
 #!/usr/bin/env python3
 """Minimal Whisper Hotkey - Press F13 to record, release to transcribe"""
+import argparse
 import os
-import subprocess
-import time
+import queue
+import re
 import threading
+import time
+import wave
 from pynput import keyboard
 import sounddevice as sd
 import numpy as np
 
+# whisper.cpp emits markers like [BLANK_AUDIO] or (upbeat music) for non-speech
+NON_SPEECH = re.compile(r"\s*\[[^\]]*\]|^\s*\([^)]*\)\s*$")
+
+def default_threads():
+    """Return an inference thread count for the cores this process may use"""
+    if hasattr(os, "sched_getaffinity"):
+        available = len(os.sched_getaffinity(0))
+    else:
+        available = os.cpu_count() or 2
+    # Leave a core for audio and input; beyond 16 threads GEMM stops scaling
+    return max(1, min(16, available - 1))
+
+def ggml_model_name(model):
+    """Return the quantized whisper.cpp model for a Whisper model name, or None"""
+    # whisper.cpp publishes q5_1 weights for the small models and q5_0 for the
+    # large ones; distil models have no GGML release under these names
+    if model.startswith(("tiny", "base", "small")):
+        return f"{model}-q5_1"
+    if model.startswith(("medium", "large-v2", "large-v3")):
+        return f"{model}-q5_0"
+    return None
+
 class SimpleWhisperHotkey:
-    def __init__(self):
+    def __init__(self, args):
+        self.args = args
         self.sample_rate = 16000
+        self.blocksize = 2048
         self.recording = False
-        self.frames = []
+        # Set on key release; capture continues until the device catches up
+        self.stop_time = None
+        self.capture_done = threading.Event()
+        # Preallocated capture buffer; the audio callback only copies into it
+        self.buffer = np.empty(self.sample_rate * 60, dtype=np.int16)
+        self.buffer_bytes = memoryview(self.buffer).cast('B')
+        self.write_index = 0
+        self.overflowed = False
         self.model = None
+        self.backend = None
+        self.warmed_up = False
+        self.warmup_seconds = 0.0
         self.trigger_key = keyboard.KeyCode(vk=269025153)  # F13 key
-        self.processing_lock = threading.Lock()
+        self.trigger_vk = self.trigger_key.vk
+        # Recordings are transcribed in order by one daemon worker, so quitting
+        # never waits on (or types out) queued clips
+        self.jobs = queue.Queue()
+        self.stopping = False
+        threading.Thread(target=self.process_jobs, daemon=True).start()
+        self.model_ready = threading.Event()
+        # Type through XTest on pynput's open display instead of spawning xdotool
+        self.keyboard = keyboard.Controller()
+
+        # faster-whisper decoding options, built once instead of per recording
+        self.decode_options = {
+            "language": "en",
+            "beam_size": args.beam_size,
+            "best_of": args.best_of,
+            "patience": 1.0,
+            # A single temperature disables the fallback re-decoding loop
+            "temperature": args.temperature,
+            "condition_on_previous_text": False,
+            "no_speech_threshold": 0.6,
+            "without_timestamps": True,
+            "vad_filter": True,
+            "vad_parameters": {
+                "min_silence_duration_ms": args.min_silence_ms,
+                "speech_pad_ms": 100
+            }
+        }
+
+        # Resolve the debug recording path once rather than on every press
+        self.debug_wav_path = None
+        if args.save_debug_wav:
+            self.debug_wav_path = os.path.expanduser("~/speech/recording.wav")
+            os.makedirs(os.path.dirname(self.debug_wav_path), exist_ok=True)
+
+        # Keep one input stream open across presses; opening a PortAudio
+        # stream per press is slow and clips the start of the recording
+        self.stream = None
+        try:
+            self.open_stream()
+        except Exception as e:
+            print(f"Error starting audio: {e}")
 
         # Load model in background
-        print("Loading Whisper model (small)...")
+        print(f"Loading Whisper model ({self.args.model})...")
         threading.Thread(target=self.load_model, daemon=True).start()
         
-        print("Whisper Hotkey ready: Press and hold F13 to record")
+        hotkey = args.evdev_key.replace("KEY_", "") if args.evdev else "F13"
+        print(f"Whisper Hotkey ready: Press and hold {hotkey} to record")
         
     def load_model(self):
         try:
-            from faster_whisper import WhisperModel
-            self.model = WhisperModel("small", device="cpu", compute_type="int8", cpu_threads=2)
-            print("Model loaded!")
+            load_start = time.perf_counter()
+            if self.args.backend == "whisper.cpp":
+                try:
+                    self.load_whisper_cpp()
+                except ImportError:
+                    print("pywhispercpp not installed, falling back to faster-whisper")
+                except Exception as e:
+                    print(f"Error loading whisper.cpp model ({e}), falling back to faster-whisper")
+            if self.model is None:
+                self.load_faster_whisper()
+            if not self.warmed_up:
+                try:
+                    self.warmup()
+                except Exception as e:
+                    print(f"Warmup failed: {e}")
+            # The CUDA check in load_faster_whisper may already have warmed up,
+            # so take the warmup time from warmup() rather than from here
+            load_seconds = time.perf_counter() - load_start - self.warmup_seconds
+            print(f"Model loaded! (load {load_seconds:.1f}s, "
+                  f"warmup {self.warmup_seconds:.1f}s)")
         except ImportError:
             print("Error: faster-whisper not installed")
             print("Install with: pip install faster-whisper")
-            exit(1)
+            # exit() would only end this thread
+            os._exit(1)
+        except Exception as e:
+            print(f"Error loading model: {e}")
+        finally:
+            # Wake up any waiting recording even if loading failed
+            self.model_ready.set()
+
+    def load_faster_whisper(self):
+        if self.args.device != "auto":
+            self.create_faster_whisper(self.args.device)
+            return
+        import ctranslate2
+        if ctranslate2.get_cuda_device_count() > 0:
+            try:
+                self.create_faster_whisper("cuda")
+                # A visible GPU doesn't mean cuBLAS/cuDNN are installed, and
+                # missing libraries often only fail on the first inference
+                self.warmup()
+                return
+            except ImportError:
+                raise
+            except Exception as e:
+                print(f"CUDA unavailable ({e}), falling back to CPU")
+                self.model = None
+        self.create_faster_whisper("cpu")
+
+    def create_faster_whisper(self, device):
+        from faster_whisper import WhisperModel
+        compute_type = self.args.compute_type
+        if compute_type is None:
+            compute_type = "int8_float16" if device == "cuda" else "int8"
+        cpu_threads = self.args.cpu_threads or default_threads()
+        self.model = WhisperModel(
+            self.args.model,
+            device=device,
+            compute_type=compute_type,
+            cpu_threads=cpu_threads,
+            num_workers=1
+        )
+        self.backend = "faster-whisper"
+        print(f"Using {device} ({compute_type})")
+
+    def load_whisper_cpp(self):
+        from pywhispercpp.model import Model
+        model_name = self.args.ggml_model or ggml_model_name(self.args.model)
+        if model_name is None:
+            raise ValueError(f"no whisper.cpp model for '{self.args.model}', use --ggml-model")
+        # Quantized GGML weights with whisper.cpp's hand-written SIMD kernels
+        self.model = Model(
+            model_name,
+            n_threads=self.args.cpu_threads or default_threads(),
+            print_progress=False,
+            print_realtime=False
+        )
+        self.backend = "whisper.cpp"
+        ignored = [flag for flag, value, default in [
+            ("--beam-size", self.args.beam_size, 1),
+            ("--best-of", self.args.best_of, 1),
+            ("--temperature", self.args.temperature, 0.0),
+            ("--min-silence-ms", self.args.min_silence_ms, 250),
+        ] if value != default]
+        if ignored:
+            print(f"Warning: {', '.join(ignored)} only apply to faster-whisper and are ignored")
+
+    def warmup(self):
+        # Run one second of silence through the model so the first recording
+        # doesn't pay for kernel selection and buffer allocation
+        warmup_start = time.perf_counter()
+        silence = np.zeros(self.sample_rate, dtype=np.float32)
+        if self.backend == "whisper.cpp":
+            self.model.transcribe(silence, language="en")
+        else:
+            segments, _ = self.model.transcribe(
+                silence,
+                language="en",
+                beam_size=1,
+                vad_filter=False
+            )
+            list(segments)
+        self.warmup_seconds = time.perf_counter() - warmup_start
+        self.warmed_up = True
+
+    def transcribe(self, audio_data):
+        if self.backend == "whisper.cpp":
+            segments = self.model.transcribe(audio_data, language="en")
+            texts = [NON_SPEECH.sub("", segment.text) for segment in segments]
+        else:
+            segments, info = self.model.transcribe(audio_data, **self.decode_options)
+            texts = [segment.text for segment in segments]
+
+        # Collect text from segments
+        return "".join(texts).strip()
+    
+    def trim_silence(self, audio_data):
+        # Drop leading/trailing silence so the encoder only sees the speech
+        frame = self.sample_rate // 100  # 10 ms
+        n_frames = audio_data.size // frame
+        if n_frames == 0:
+            return audio_data
+        # Per-frame energy in one pass, without materializing an abs() copy
+        frames = audio_data[:n_frames * frame].reshape(n_frames, frame)
+        energy = np.einsum('ij,ij->i', frames, frames)
+        # Speech must be ~10 dB (3x RMS) above the clip's noise floor, taken as
+        # its quietest frames, and never below the configured minimum level
+        noise_floor = np.percentile(energy, 10)
+        limit = max(9 * noise_floor, self.args.silence_threshold ** 2 * frame)
+        voiced = np.flatnonzero(energy > limit)
+        if voiced.size == 0:
+            return audio_data[:0]
+        pad = 10  # keep 100 ms either side so word edges aren't clipped
+        start = max(voiced[0] - pad, 0) * frame
+        end = min((voiced[-1] + 1 + pad) * frame, audio_data.size)
+        return audio_data[start:end]
     
     def audio_callback(self, indata, frames, time, status):
         if self.recording:
-            self.frames.append(indata.copy())
+            start = self.write_index
+            end = start + frames
+            if end <= self.buffer.size:
+                itemsize = self.buffer.itemsize
+                self.buffer_bytes[start * itemsize:end * itemsize] = indata
+                self.write_index = end
+            else:
+                self.overflowed = True
+            # A block captured after the release means nothing spoken before it
+            # is still sitting in the device buffers
+            if self.stop_time is not None and time.inputBufferAdcTime > self.stop_time:
+                self.recording = False
+                self.capture_done.set()
+    
+    def open_stream(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        self.stream = sd.RawInputStream(
+            samplerate=self.sample_rate,
+            channels=1,
+            callback=self.audio_callback,
+            dtype='int16',
+            blocksize=self.blocksize
+        )
+        self.stream.start()
     
     def start_recording(self):
-        if self.processing_lock.locked():
-            return
+        # Reopen if there was no mic at launch or the stream has since died
+        # (device unplugged, default source changed, callback error)
+        if self.stream is None or not self.stream.active:
+            try:
+                self.open_stream()
+            except Exception as e:
+                print(f"Error starting audio: {e}")
+                return
             
-        self.frames = []
+        self.write_index = 0
+        self.overflowed = False
+        self.stop_time = None
+        self.capture_done.clear()
         self.recording = True
-        
+        print("Recording...")
+    
+    def process_audio(self, samples):
         try:
-            self.stream = sd.InputStream(
-                samplerate=self.sample_rate,
-                channels=1,
-                callback=self.audio_callback,
-                dtype='float32'
-            )
-            self.stream.start()
-            print("Recording...")
+            # Optionally keep a copy of the recording for debugging
+            if self.debug_wav_path:
+                # Samples are already PCM16, so this is a header plus one write
+                with wave.open(self.debug_wav_path, 'wb') as wf:
+                    wf.setnchannels(1)
+                    wf.setsampwidth(2)
+                    wf.setframerate(self.sample_rate)
+                    wf.writeframes(samples.tobytes())
+
+            # Whisper expects float32 in [-1, 1); convert and scale in one pass
+            audio_data = np.multiply(samples, 1.0 / 32768.0, dtype=np.float32)
+            audio_data = self.trim_silence(audio_data)
+            if audio_data.size == 0:
+                print("No speech detected")
+                return
+            
+            # Wait for model to load if necessary
+            if not self.model_ready.is_set():
+                print("Waiting for model to load...")
+                self.model_ready.wait()
+            if self.model is None:
+                print("Model not available, skipping transcription")
+                return
+            
+            # Transcribe
+            text = self.transcribe(audio_data)
+            
+            if self.stopping:
+                return
+            if text:
+                print(f"Transcribed: {text}")
+                self.keyboard.type(text)
+            else:
+                print("No speech detected")
+                
         except Exception as e:
-            print(f"Error starting audio: {e}")
-            self.recording = False
+            print(f"Error processing audio: {e}")
     
-    def process_audio(self):
-        with self.processing_lock:
-            try:
-                # Process audio data
-                audio_data = np.concatenate(self.frames, axis=0)
-                
-                # Save to temporary WAV
-                import soundfile as sf
-                os.makedirs(os.path.expanduser("~/speech"), exist_ok=True)
-                wav_path = os.path.expanduser("~/speech/recording.wav")
-                sf.write(wav_path, audio_data, self.sample_rate)
-                
-                # Wait for model to load if necessary
-                while self.model is None:
-                    print("Waiting for model to load...")
-                    time.sleep(0.5)
-                
-                # Transcribe
-                segments, info = self.model.transcribe(
-                    wav_path,
-                    language="en",
-                    beam_size=5,
-                    vad_filter=True
-                )
-                
-                # Collect text from segments
-                text = ""
-                for segment in segments:
-                    text += segment.text
-                
-                text = text.strip()
-                
-                if text:
-                    print(f"Transcribed: {text}")
-                    subprocess.run(['xdotool', 'type', text], check=True)
-                else:
-                    print("No speech detected")
-                    
-            except Exception as e:
-                print(f"Error processing audio: {e}")
+    def process_jobs(self):
+        while True:
+            self.process_audio(self.jobs.get())
     
     def stop_recording(self):
         if not self.recording:
             return
             
+        # Audio up to the release is still in flight (input latency plus the
+        # partly filled block), so keep capturing until it has been delivered.
+        # Some backends report no ADC times; the timeout covers those.
+        if self.stream.active:
+            self.stop_time = self.stream.time
+            self.capture_done.wait(self.stream.latency + 2 * self.blocksize / self.sample_rate)
         self.recording = False
-        if hasattr(self, 'stream') and self.stream is not None:
-            self.stream.stop()
-            self.stream.close()
-            self.stream = None
             
-        if not self.frames:
+        if self.write_index == 0:
             print("No audio recorded")
             return
+
+        # The worker gets its own copy so the next recording can start right
+        # away; a single worker keeps transcriptions (and typed text) in order
+        samples = self.buffer[:self.write_index].copy()
+
+        if self.overflowed:
+            # Grow for next time, away from the audio thread
+            print("Recording too long, audio was truncated")
+            self.buffer = np.empty(self.buffer.size * 2, dtype=self.buffer.dtype)
+            self.buffer_bytes = memoryview(self.buffer).cast('B')
             
         print("Processing...")
-        
-        # Process in separate thread to keep UI responsive
-        threading.Thread(target=self.process_audio, daemon=True).start()
+        self.jobs.put(samples)
+    
+    def trigger_down(self):
+        if self.recording:
+            return
+        self.start_recording()
+    
+    def trigger_up(self):
+        if self.recording:
+            self.stop_recording()
     
     def on_press(self, key):
-        if key == self.trigger_key and not self.recording and not self.processing_lock.locked():
-            self.start_recording()
+        # Cheap vk check first; this runs for every key pressed system-wide
+        if getattr(key, 'vk', None) == self.trigger_vk:
+            self.trigger_down()
     
     def on_release(self, key):
-        if key == self.trigger_key and self.recording:
-            self.stop_recording()
+        if getattr(key, 'vk', None) == self.trigger_vk:
+            self.trigger_up()
     
-    def run(self):
-        # Check for required tools
+    def listen_evdev(self, path, key_name):
+        # Read one input device directly; only hotkey events reach Python code
         try:
-            subprocess.run(['which', 'xdotool'], check=True)
-        except subprocess.CalledProcessError:
-            print("Error: xdotool not installed")
-            print("Install with: sudo apt install xdotool")
+            from evdev import InputDevice, ecodes
+        except ImportError:
+            print("Error: evdev not installed")
+            print("Install with: pip install evdev")
+            return
+        key_code = ecodes.ecodes.get(key_name)
+        if key_code is None:
+            print(f"Error: unknown evdev key name {key_name}")
             return
-        
-        # Start non-blocking keyboard listener
-        listener = keyboard.Listener(
-            on_press=self.on_press, 
-            on_release=self.on_release
-        )
-        listener.start()
-        
-        # Keep main thread alive
         try:
-            while True:
-                time.sleep(0.1)
+            device = InputDevice(path)
+        except OSError as e:
+            print(f"Error opening {path}: {e}")
+            print("Check the device path and that your user can read it (e.g. the input group)")
+            return
+        for event in device.read_loop():
+            if event.type != ecodes.EV_KEY or event.code != key_code:
+                continue
+            if event.value == 1:
+                self.trigger_down()
+            elif event.value == 0:
+                self.trigger_up()
+    
+    def run(self):
+        try:
+            if self.args.evdev:
+                self.listen_evdev(self.args.evdev, self.args.evdev_key)
+                return
+
+            # Start non-blocking keyboard listener
+            listener = keyboard.Listener(
+                on_press=self.on_press, 
+                on_release=self.on_release
+            )
+            listener.start()
+            
+            # Block on the listener thread; all work happens in its callbacks
+            try:
+                listener.join()
+            finally:
+                listener.stop()
         except KeyboardInterrupt:
             print("Exiting...")
+        finally:
+            if self.stream is not None:
+                self.stream.close()
+            self.stopping = True
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Press F13 to record, release to transcribe")
+    parser.add_argument("--model", default="small",
+                        help="Whisper model, e.g. tiny, base, small, medium, distil-small.en (default: small)")
+    parser.add_argument("--backend", choices=["faster-whisper", "whisper.cpp"],
+                        default="faster-whisper",
+                        help="Inference backend; whisper.cpp needs pywhispercpp (default: faster-whisper)")
+    parser.add_argument("--ggml-model", metavar="NAME_OR_PATH",
+                        help="whisper.cpp model name or .bin path (default: quantized variant of --model)")
+    parser.add_argument("--device", choices=["auto", "cpu", "cuda"], default="auto",
+                        help="Device for faster-whisper; auto uses CUDA when available (default: auto)")
+    parser.add_argument("--compute-type",
+                        choices=["auto", "int8", "int8_float32", "int8_float16", "int16", "float16", "float32"],
+                        help="CTranslate2 compute type; auto lets CTranslate2 pick the fastest supported "
+                             "type (default: int8_float16 on CUDA, int8 on CPU)")
+    parser.add_argument("--cpu-threads", type=int,
+                        help="Inference threads (default: one less than the available cores, at most 16)")
+    parser.add_argument("--evdev", metavar="DEVICE",
+                        help="Read the hotkey (see --evdev-key) from this evdev device (e.g. /dev/input/by-id/...-event-kbd) "
+                             "instead of a global X keyboard listener")
+    parser.add_argument("--evdev-key", default="KEY_F13",
+                        help="evdev key name for the hotkey in --evdev mode (default: KEY_F13)")
+    parser.add_argument("--save-debug-wav", action="store_true",
+                        help="Also save each recording to ~/speech/recording.wav")
+    parser.add_argument("--beam-size", type=int, default=1,
+                        help="Beam size for decoding (default: 1, greedy)")
+    parser.add_argument("--best-of", type=int, default=1,
+                        help="Candidates when sampling with non-zero temperature (default: 1)")
+    parser.add_argument("--temperature", type=float, default=0.0,
+                        help="Decoding temperature; no fallback to higher temperatures (default: 0.0)")
+    parser.add_argument("--silence-threshold", type=float, default=0.01,
+                        help="Minimum RMS level (0-1) counted as speech when trimming silence; the gate "
+                             "also adapts to ~10 dB above each clip's noise floor (default: 0.01)")
+    parser.add_argument("--min-silence-ms", type=int, default=250,
+                        help="Silence length in ms that splits VAD segments (default: 250)")
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    app = SimpleWhisperHotkey()
+    app = SimpleWhisperHotkey(parse_args())
     app.run()
\ No newline at end of file